@@ -16,4 +16,24 @@ def get_logger(name: str) -> logging.Logger:
 NATS_HOST = os.getenv("NATS_HOST", "nats-server")
 NATS_PORT = int(os.getenv("NATS_PORT", 4222))
 NATS_ANSWER_TOPIC = os.getenv("NATS_ANSWER_TOPIC", "answer")
-OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
\ No newline at end of file
+OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
+DSPY_CACHE_DIR = os.getenv("DSPY_CACHE_DIR", os.path.expanduser("~/.dspy_cache"))
+# Shared HTTP/2 pool for LiteLLM requests to the LM provider
+LM_MAX_CONNECTIONS = int(os.getenv("LM_MAX_CONNECTIONS", 64))
+LM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LM_MAX_KEEPALIVE_CONNECTIONS", 32))
+LM_TIMEOUT_S = float(os.getenv("LM_TIMEOUT_S", 60))
+ANSWER_CACHE_DIR = os.getenv("ANSWER_CACHE_DIR", "answer-cache")
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.95))
+# Upper bound on question embeddings held in memory for semantic answer-cache hits
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 50000))
+ANSWER_CONTEXT_MAX_ROWS = int(os.getenv("ANSWER_CONTEXT_MAX_ROWS", 200))
+# Micro-batching of LLM calls; meant for benchmark mode where reply ordering doesn't matter
+ANSWER_BATCHING = os.getenv("ANSWER_BATCHING", "false").lower() == "true"
+ANSWER_BATCH_MAX_SIZE = int(os.getenv("ANSWER_BATCH_MAX_SIZE", 8))
+ANSWER_BATCH_WAIT_MS = float(os.getenv("ANSWER_BATCH_WAIT_MS", 50))
+# Memcached tier shared by replicas (question + rows -> answer); unset host disables it
+MEMCACHE_HOST = os.getenv("MEMCACHE_HOST", "")
+MEMCACHE_PORT = int(os.getenv("MEMCACHE_PORT", 11211))
+MEMCACHE_POOL_SIZE = int(os.getenv("MEMCACHE_POOL_SIZE", 8))
+DB2A_TTL = int(os.getenv("DB2A_TTL", 7 * 86400))  # seconds
@@ -1,7 +1,7 @@
 import asyncio
-import json
 import signal
 import time
+import orjson
 from nats.aio.client import Client as NATS
 from nats.aio.msg import Msg as NATSMsg
 
@@ -12,8 +12,18 @@ from .config import (
     NATS_PORT,
     NATS_ANSWER_TOPIC as topic,
     OPENROUTER_API_KEY,
+    DSPY_CACHE_DIR,
+    ANSWER_CONTEXT_MAX_ROWS,
+    ANSWER_BATCHING,
+    ANSWER_BATCH_MAX_SIZE,
+    ANSWER_BATCH_WAIT_MS,
+    DB2A_TTL,
     get_logger
 )
+from .modules.answer_cache import CachedAnswerGenerator
+from .modules.lm_client import PooledLM, make_http_handler
+from .modules.micro_batcher import MicroBatcher
+from .modules.shared_cache import SharedCache, prompt_version
 
 shutdown = False
 def handle_shutdown(signum, frame):
@@ -26,11 +36,14 @@ signal.signal(signal.SIGTERM, handle_shutdown)
 logger = get_logger("main")
 
 # Same DSPy configuration of query-service
-lm = dspy.LM(
+lm = PooledLM(
     "openrouter/google/gemini-2.0-flash-001",
+    http_handler=make_http_handler(),
     api_key=OPENROUTER_API_KEY,
 )
 dspy.configure(lm=lm)
+# LM responses are cached in memory and on disk; point the disk cache at a volume so it survives restarts
+dspy.configure_cache(enable_disk_cache=True, enable_memory_cache=True, disk_cache_dir=DSPY_CACHE_DIR)
 
 # DSPy Signature for answer generation
 class AnswerQuestion(dspy.Signature):
@@ -44,59 +57,171 @@ class AnswerQuestion(dspy.Signature):
     context: str = dspy.InputField()
     response: str = dspy.OutputField()
 
+class BatchAnswerQuestion(dspy.Signature):
+    """
+    Answer each question independently, using only its own Cypher query and context (same index in each list).
+    - If a context is empty, state that you don't have enough information to answer that question.
+    - When dealing with dates, mention the month in full.
+    - Return exactly one response per question, in the same order.
+    """
+    questions: list[str] = dspy.InputField()
+    cypher_queries: list[str] = dspy.InputField()
+    contexts: list[str] = dspy.InputField()
+    responses: list[str] = dspy.OutputField()
+
+def format_context(columns: list[str], rows: list[list]) -> str:
+    """Compact JSON of the first ANSWER_CONTEXT_MAX_ROWS rows, to bound the prompt size."""
+    context = orjson.dumps({"columns": columns, "rows": rows[:ANSWER_CONTEXT_MAX_ROWS]}).decode()
+    if len(rows) > ANSWER_CONTEXT_MAX_ROWS:
+        context += f" ... ({len(rows) - ANSWER_CONTEXT_MAX_ROWS} more rows truncated)"
+    return context
+
 # Create the answer generator module
 answer_generator = dspy.ChainOfThought(AnswerQuestion)
+batch_answer_generator = dspy.ChainOfThought(BatchAnswerQuestion)
+cached_answer_generator = CachedAnswerGenerator()
+# Shared (question, cypher, context) -> answer tier behind the replica-local cache
+shared_answers = SharedCache("db2a", prompt_version(lm.model, AnswerQuestion.instructions, BatchAnswerQuestion.instructions), DB2A_TTL)
+# Yields response chunks while the LM generates them, then the final Prediction
+streaming_answer_generator = dspy.streamify(
+    answer_generator,
+    stream_listeners=[dspy.streaming.StreamListener(signature_field_name="response")],
+)
 
-async def message_handler(msg: NATSMsg):
+def generate_answer(question: str, cypher: str, context: str) -> str:
+    return answer_generator(question=question, cypher_query=cypher, context=context).response
+
+def _generate_each(items: list[tuple[str, str, str]]) -> list[str | Exception]:
+    # Failures are returned in place, so the batcher fails only that question
+    results = []
+    for item in items:
+        try:
+            results.append(generate_answer(*item))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def generate_answers(items: list[tuple[str, str, str]]) -> list[str | Exception]:
+    questions, cyphers, contexts = (list(col) for col in zip(*items))
     try:
-        parsed_data = json.loads(msg.data.decode())
-        logger.debug(
-            f"Received a message on '{msg.subject}': \n"
-            f" question: {parsed_data['question']} \n"
-            f" cypher: {parsed_data['cypher']} \n"
-            f" columns: {parsed_data['columns']} \n"
-            f" rows: {len(parsed_data['rows'])}"
-        )
+        responses = batch_answer_generator(questions=questions, cypher_queries=cyphers, contexts=contexts).responses
+    except Exception as e:
+        # e.g. adapter parse errors on the list output; one bad batch must not fail every question in it
+        logger.warning(f"Batch of {len(items)} answers failed ({e}), answering one by one")
+        return _generate_each(items)
+    if len(responses) != len(items):
+        logger.warning(f"Batch returned {len(responses)} answers for {len(items)} questions, answering one by one")
+        return _generate_each(items)
+    return responses
+
+# Created in main() when ANSWER_BATCHING is on
+batcher: MicroBatcher[str] | None = None
+_inflight: set[asyncio.Task] = set()
+# Connected in main(); answer chunks are published on it
+_NC: NATS | None = None
+
+async def publish_chunk(stream_to: str, chunk: str):
+    await _NC.publish(stream_to, orjson.dumps({"chunk": chunk}))
+
+async def stream_answer(stream_to: str, question: str, cypher: str, context: str) -> str:
+    """Generates the answer, publishing each chunk to stream_to as it arrives; returns the full answer."""
+    answer = ""
+    streamed = False
+    async for part in streaming_answer_generator(question=question, cypher_query=cypher, context=context):
+        if isinstance(part, dspy.streaming.StreamResponse):
+            if part.chunk:
+                await publish_chunk(stream_to, part.chunk)
+                streamed = True
+        elif isinstance(part, dspy.Prediction):
+            answer = part.response
+    if not streamed:
+        # LM cache hits come back whole, without chunks
+        await publish_chunk(stream_to, answer)
+    return answer
+
+async def dispatch(msg: NATSMsg):
+    # nats-py awaits callbacks one at a time; run each message as its own task
+    # (keeping a reference so it isn't garbage collected) to handle them concurrently
+    task = asyncio.create_task(message_handler(msg))
+    _inflight.add(task)
+    task.add_done_callback(_inflight.discard)
 
+async def message_handler(msg: NATSMsg):
+    try:
+        parsed_data = orjson.loads(msg.data)
         question = parsed_data.get("question", "")
         cypher = parsed_data.get("cypher", "")
+        columns = parsed_data.get("columns", [])
         rows = parsed_data.get("rows", [])
+        # Set by streaming callers: answer chunks are published there before the reply
+        stream_to = parsed_data.get("stream_to")
 
-        # Format the results as context for the LLM
-        # Following the professor codebase: flatten rows into a simple list
-        context = str([item for row in rows for item in row])
-
-        t0 = time.perf_counter()
-        result = answer_generator(
-            question=question,
-            cypher_query=cypher,
-            context=context
+        # %-style arguments: the message is only formatted if DEBUG is enabled
+        logger.debug(
+            "Received a message on '%s': \n question: %s \n cypher: %s \n columns: %s \n rows: %d",
+            msg.subject, question, cypher, columns, len(rows)
         )
-        answer_gen_time = (time.perf_counter() - t0) * 1000
-        answer = result.response
 
-        logger.info(f"Generated answer for: '{question}'")
+        # Format the results as context for the LLM
+        context = format_context(columns, rows)
+
+        t0 = time.perf_counter_ns()
+        # Disk reads and embedding block, so keep them off the event loop
+        answer, cache_tier, q_emb = await asyncio.to_thread(
+            cached_answer_generator.lookup,
+            question,
+            cypher,
+            context,
+            question_embedding=parsed_data.get("question_embedding"),
+        )
+        if answer is None:
+            # Another replica may already have answered it
+            key = (question.strip().lower(), cypher, context)
+            answer = await shared_answers.get(*key)
+            if answer is not None:
+                cache_tier = "shared"
+            elif stream_to:
+                # Streams can't share a batched call, so they always take the single path
+                answer = await stream_answer(stream_to, question, cypher, context)
+            elif batcher is not None:
+                answer = await batcher.submit(question, cypher, context)
+            else:
+                answer = await asyncio.to_thread(generate_answer, question, cypher, context)
+            if cache_tier == "miss":
+                shared_answers.put(answer, *key)
+            await asyncio.to_thread(cached_answer_generator.store, question, cypher, context, q_emb, answer)
+        if stream_to and cache_tier != "miss":
+            await publish_chunk(stream_to, answer)
+        answer_gen_time = (time.perf_counter_ns() - t0) / 1e6
+
+        logger.info(f"Generated answer for: '{question}' (cache: {cache_tier})")
         
         response_payload = {
             "answer": answer,
             "timings": {
-                "llm_generation_ms": answer_gen_time
+                "llm_generation_ms": answer_gen_time,
+                "answer_cache": cache_tier
             }
         }
-        await msg.respond(json.dumps(response_payload).encode("utf-8"))
+        await msg.respond(orjson.dumps(response_payload))
 
     except Exception as e:
         logger.error(f"Error in message handler: {e}")
-        error_msg = json.dumps({"error": "Sorry, I encountered an error while generating the answer."})
-        await msg.respond(error_msg.encode("utf-8"))
+        error_msg = orjson.dumps({"error": "Sorry, I encountered an error while generating the answer."})
+        await msg.respond(error_msg)
 
 async def main():
+    global batcher, _NC
     logger.info("Starting Answer Service...")
 
+    if ANSWER_BATCHING:
+        batcher = MicroBatcher(generate_answer, generate_answers, ANSWER_BATCH_MAX_SIZE, ANSWER_BATCH_WAIT_MS)
+        batcher.start()
 
-    nc = NATS()
+    nc = _NC = NATS()
     await nc.connect(f"nats://{NATS_HOST}:{NATS_PORT}")
-    await nc.subscribe(topic, cb=message_handler)
+    # Queue group: replicas share the subscription instead of each receiving every message
+    await nc.subscribe(topic, queue=f"{topic}.workers", cb=dispatch)
 
     logger.debug(f"Subscribed to topic '{topic}' on NATS server at {NATS_HOST}:{NATS_PORT}")
 
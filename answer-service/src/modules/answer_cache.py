@@ -0,0 +1,113 @@
+# --- deps ---
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from diskcache import Cache  # installed with dspy
+
+from ..config import (
+    ANSWER_CACHE_DIR,
+    EMBEDDING_MODEL,
+    SEMANTIC_CACHE_MAX_ENTRIES,
+    SEMANTIC_CACHE_THRESHOLD,
+    get_logger,
+)
+
+logger = get_logger("answer_cache")
+
+
+def _exact_key(question: str, cypher: str, context: str) -> str:
+    return hashlib.sha256((question.strip().lower() + "\0" + cypher + "\0" + context).encode()).hexdigest()
+
+
+def _group_key(cypher: str, context: str) -> str:
+    # Semantic hits are only allowed between questions that produced the same
+    # Cypher query and therefore the same rows.
+    return hashlib.sha256((cypher + "\0" + context).encode()).hexdigest()
+
+
+class CachedAnswerGenerator:
+    """
+    Two-tier cache in front of the DSPy answer generator.
+
+    1) Exact: SHA-256 of the normalized (question, cypher, context) tuple, persisted with diskcache.
+    2) Semantic: cosine similarity of question embeddings among entries with the same cypher + context.
+       Kept in memory and bounded to max_entries embeddings, evicting the least recently used groups.
+
+    lookup and store are called from worker threads.
+    """
+
+    def __init__(self, cache_dir: str = ANSWER_CACHE_DIR, threshold: float = SEMANTIC_CACHE_THRESHOLD, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.cache = Cache(cache_dir)
+        self._model = None
+        self._model_lock = threading.Lock()
+        self._lock = threading.Lock()
+        # group key -> (embedding matrix, answers), in LRU order
+        self._groups: OrderedDict[str, tuple[np.ndarray, list[str]]] = OrderedDict()
+        self._entries = 0
+        for key in self.cache.iterkeys():
+            if self._entries >= max_entries:
+                break
+            entry = self.cache.get(key)
+            if entry is not None:
+                self._add_to_group(*entry)
+        logger.info(f"Loaded {self._entries} of {len(self.cache)} cached answers into the semantic index from '{cache_dir}'")
+
+    def _embed(self, question: str) -> np.ndarray:
+        if self._model is None:
+            # Loaded lazily so the service starts without waiting for the model;
+            # the lock keeps concurrent first lookups from each loading one
+            with self._model_lock:
+                if self._model is None:
+                    from sentence_transformers import SentenceTransformer
+                    self._model = SentenceTransformer(EMBEDDING_MODEL)
+        return self._model.encode([question], normalize_embeddings=True)[0].astype(np.float32)
+
+    def _add_to_group(self, group: str, emb: np.ndarray, answer: str) -> None:
+        with self._lock:
+            if group in self._groups:
+                matrix, answers = self._groups.pop(group)
+                self._groups[group] = (np.vstack([matrix, emb]), answers + [answer])
+            else:
+                self._groups[group] = (emb[np.newaxis, :], [answer])
+            self._entries += 1
+            # Evict whole groups, oldest first, but never the one just added to
+            while self._entries > self.max_entries and len(self._groups) > 1:
+                _, (_, evicted) = self._groups.popitem(last=False)
+                self._entries -= len(evicted)
+
+    def lookup(self, question: str, cypher_query: str, context: str, question_embedding: list[float] | None = None) -> tuple[str | None, str, np.ndarray | None]:
+        """
+        Returns (answer, cache tier, question embedding); the answer is None on a miss.
+        question_embedding, when the query-service already computed it, avoids embedding twice.
+        """
+        hit = self.cache.get(_exact_key(question, cypher_query, context))
+        if hit is not None:
+            return hit[2], "exact", None
+
+        group = _group_key(cypher_query, context)
+        if question_embedding is not None:
+            emb = np.asarray(question_embedding, dtype=np.float32)
+        else:
+            emb = self._embed(question)
+        with self._lock:
+            entry = self._groups.get(group)
+            if entry is not None:
+                self._groups.move_to_end(group)
+        if entry is not None:
+            matrix, answers = entry
+            sims = matrix @ emb
+            best = int(sims.argmax())
+            if sims[best] >= self.threshold:
+                return answers[best], "semantic", emb
+        return None, "miss", emb
+
+    def store(self, question: str, cypher_query: str, context: str, emb: np.ndarray, answer: str) -> None:
+        group = _group_key(cypher_query, context)
+        self.cache.set(_exact_key(question, cypher_query, context), (group, emb, answer))
+        self._add_to_group(group, emb, answer)
+
+__all__ = ["CachedAnswerGenerator"]
@@ -13,4 +13,33 @@ def get_logger(name: str) -> logging.Logger:
 NATS_HOST = os.getenv("NATS_HOST", "nats-server")
 NATS_PORT = int(os.getenv("NATS_PORT", 4222))
 NATS_DB_QUERY_TOPIC = os.getenv("NATS_DB_QUERY_TOPIC", "db-query")
-KUZU_DB_PATH = os.getenv("KUZU_DB_PATH", "graph.db")
\ No newline at end of file
+NATS_SCHEMA_RELOAD_TOPIC = os.getenv("NATS_SCHEMA_RELOAD_TOPIC", "db-query.schema-reload")
+NATS_ANSWER_TOPIC = os.getenv("NATS_ANSWER_TOPIC", "answer")
+# Question -> answer in one request: the query-service forwards its result to the answer-service itself
+NATS_PIPELINE_TOPIC = os.getenv("NATS_PIPELINE_TOPIC", "pipeline.qa")
+KUZU_DB_PATH = os.getenv("KUZU_DB_PATH", "graph.db")
+# Extracted schema, stored next to the database so restarts can skip the catalog queries
+KUZU_SCHEMA_PATH = os.getenv("KUZU_SCHEMA_PATH", f"{KUZU_DB_PATH}.schema.json")
+DSPY_CACHE_DIR = os.getenv("DSPY_CACHE_DIR", os.path.expanduser("~/.dspy_cache"))
+# Threads available to asyncified DSPy modules; should cover the expected concurrent requests
+DSPY_ASYNC_MAX_WORKERS = int(os.getenv("DSPY_ASYNC_MAX_WORKERS", 16))
+# Shared HTTP/2 pool for LiteLLM requests to the LM provider
+LM_MAX_CONNECTIONS = int(os.getenv("LM_MAX_CONNECTIONS", 64))
+LM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LM_MAX_KEEPALIVE_CONNECTIONS", 32))
+LM_TIMEOUT_S = float(os.getenv("LM_TIMEOUT_S", 60))
+KUZU_BUFFER_POOL_SIZE = int(os.getenv("KUZU_BUFFER_POOL_SIZE", 0))  # 0 lets Kuzu pick a default
+KUZU_POOL_SIZE = int(os.getenv("KUZU_POOL_SIZE", 4))
+# Worker processes, each with its own read-only Database and NATS connection (1 = run in-process)
+QUERY_WORKERS = int(os.getenv("QUERY_WORKERS", 1))
+VALIDATION_CACHE_SIZE = int(os.getenv("VALIDATION_CACHE_SIZE", 4096))
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "sentence-transformers/all-MiniLM-L6-v2")
+# Micro-batching of prune/text2cypher LLM calls; meant for benchmark mode where many questions arrive at once
+QUERY_BATCHING = os.getenv("QUERY_BATCHING", "false").lower() == "true"
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", 8))
+QUERY_BATCH_WAIT_MS = float(os.getenv("QUERY_BATCH_WAIT_MS", 20))
+# Memcached tiers shared by replicas (question -> cypher, cypher -> rows); unset host disables them
+MEMCACHE_HOST = os.getenv("MEMCACHE_HOST", "")
+MEMCACHE_PORT = int(os.getenv("MEMCACHE_PORT", 11211))
+MEMCACHE_POOL_SIZE = int(os.getenv("MEMCACHE_POOL_SIZE", 8))
+Q2CY_TTL = int(os.getenv("Q2CY_TTL", 7 * 86400))  # seconds; LLM translations only change with the prompt
+CY2DB_TTL = int(os.getenv("CY2DB_TTL", 300))  # seconds; bounds staleness if the database is rebuilt
@@ -1,8 +1,16 @@
 import asyncio
+import logging
+import multiprocessing
+import os
+import queue
+from collections import OrderedDict
 import signal
-import json
 import kuzu
+import numpy as np
+import orjson
 import time
+from functools import partial
+from typing import Awaitable, Callable, TypeVar
 
 from nats.aio.client import Client as NATS
 from nats.aio.msg import Msg as NATSMsg
@@ -11,7 +19,19 @@ from .config import (
     NATS_HOST,
     NATS_PORT,
     NATS_DB_QUERY_TOPIC as topic,
+    NATS_SCHEMA_RELOAD_TOPIC as schema_reload_topic,
+    NATS_ANSWER_TOPIC as answer_topic,
+    NATS_PIPELINE_TOPIC as pipeline_topic,
     KUZU_DB_PATH,      
+    KUZU_SCHEMA_PATH,
+    KUZU_BUFFER_POOL_SIZE,
+    KUZU_POOL_SIZE,
+    QUERY_WORKERS,
+    VALIDATION_CACHE_SIZE,
+    CY2DB_TTL,
+    QUERY_BATCHING,
+    QUERY_BATCH_MAX_SIZE,
+    QUERY_BATCH_WAIT_MS,
     get_logger,
 )
 
@@ -23,23 +43,105 @@ def handle_shutdown(signum, frame):
 signal.signal(signal.SIGINT, handle_shutdown)
 signal.signal(signal.SIGTERM, handle_shutdown)
 
-from .modules.text2cypher import generate_cypher, repair_cypher, get_schema_dict
+from .modules.text2cypher import generate_cypher, normalize_question, remember_generation, repair_cypher, get_schema_dict, invalidate_schema_cache, enable_batching
+from .modules.embeddings import embed_question
+from .modules.shared_cache import SharedCache
 
 logger = get_logger("main")
 
+# Opened once in main(): the database is read-only, so connections and the schema can be shared
+_DB: kuzu.Database | None = None
+_POOL: queue.Queue[kuzu.Connection] = queue.Queue()
+_SCHEMA: dict[str, list[dict]] = {}
+# Connected in main(); pipeline requests are forwarded to the answer-service on it
+_NC: NATS | None = None
+# Bounds in-flight Kuzu work to the pool size so _POOL.get() never blocks the event loop
+_DB_SEMAPHORE = asyncio.Semaphore(KUZU_POOL_SIZE)
+# LRU of Cypher strings that already passed EXPLAIN against this (static) database
+_VALID: OrderedDict[str, bool] = OrderedDict()
+# Normalized question -> validated Cypher, LRU-ordered. Exact matches only: questions that
+# differ in a year, number or name embed almost identically but need a different query.
+_CYPHER_CACHE: OrderedDict[str, str] = OrderedDict()
+# Shared (db path, cypher) -> (columns, rows) tier; a short TTL bounds staleness after a rebuild
+_CY2DB = SharedCache("cy2db", "v1", CY2DB_TTL)
+_inflight: set[asyncio.Task] = set()
 
-def self_refinement_loop(question: str, full_schema: dict, conn: kuzu.Connection) -> tuple[str, dict]:
+T = TypeVar("T")
+
+
+async def _with_connection(fn: Callable[[kuzu.Connection], T]) -> T:
+    """Runs fn(conn) in a worker thread on a pooled connection, held only for that call."""
+    async with _DB_SEMAPHORE:
+        conn = _POOL.get()
+        try:
+            return await asyncio.to_thread(fn, conn)
+        finally:
+            _POOL.put(conn)
+
+
+def _explain(cypher: str, conn: kuzu.Connection) -> None:
+    # EXPLAIN checks syntax and binding without running the full query plan
+    conn.execute(f"EXPLAIN {cypher}")
+
+
+def _dumps(obj) -> bytes:
+    # Kuzu values may be numpy scalars, MAPs with non-string keys, or types orjson
+    # doesn't know (Decimal, timedelta) -- the latter are sent as strings
+    return orjson.dumps(obj, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+
+
+def _fetch_rows(res: kuzu.QueryResult) -> list[tuple]:
+    # Pull the result as one columnar Arrow table and convert column-wise, rather
+    # than crossing into the driver once per row
+    table = res.get_as_arrow()
+    return list(zip(*(col.to_pylist() for col in table.columns)))
+
+
+def _execute(cypher: str, conn: kuzu.Connection) -> tuple[list[str], list[tuple], float]:
+    """Returns (columns, rows, execution time in ms); the result never outlives the connection checkout."""
+    t0 = time.perf_counter_ns()
+    res = conn.execute(cypher)
+    exec_time = (time.perf_counter_ns() - t0) / 1e6
+    # In Kuzu 0.11+, use get_column_names() instead of column_names()
+    return res.get_column_names(), _fetch_rows(res), exec_time
+
+
+def _mark_validated(cypher: str) -> None:
+    _VALID[cypher] = True
+    _VALID.move_to_end(cypher)
+    if len(_VALID) > VALIDATION_CACHE_SIZE:
+        _VALID.popitem(last=False)
+
+
+def _remember_cypher(question: str, cypher: str) -> None:
+    key = normalize_question(question)
+    _CYPHER_CACHE[key] = cypher
+    _CYPHER_CACHE.move_to_end(key)
+    if len(_CYPHER_CACHE) > VALIDATION_CACHE_SIZE:
+        _CYPHER_CACHE.popitem(last=False)
+
+
+async def self_refinement_loop(question: str, full_schema: dict, q_emb: np.ndarray) -> tuple[str, dict]:
     timings = {
         "initial_generation_time_ms": 0.0,
         "retries": [],
         "total_llm_time_ms": 0.0,
         "total_validation_time_ms": 0.0
     }
+
+    # 0. Reuse the validated query of the same earlier question
+    key = normalize_question(question)
+    cypher = _CYPHER_CACHE.get(key)
+    if cypher is not None:
+        _CYPHER_CACHE.move_to_end(key)
+        timings["cypher_cache"] = "hit"
+        logger.info(f"Reusing cached query: {cypher}")
+        return cypher, timings
     
     # 1. Generate
-    t0 = time.perf_counter()
-    cypher, pruned_schema = generate_cypher(question, full_schema)
-    gen_time = (time.perf_counter() - t0) * 1000
+    t0 = time.perf_counter_ns()
+    cypher, pruned_schema = await generate_cypher(question, full_schema, q_emb)
+    gen_time = (time.perf_counter_ns() - t0) / 1e6
     timings["initial_generation_time_ms"] = gen_time
     timings["total_llm_time_ms"] += gen_time
 
@@ -47,14 +149,24 @@ def self_refinement_loop(question: str, full_schema: dict, conn: kuzu.Connection
     max_retries = 3
     for attempt in range(max_retries):
         retry_info = {"attempt": attempt + 1, "validation_time_ms": 0.0, "repair_time_ms": 0.0, "status": "unknown"}
+        if cypher in _VALID:
+            _VALID.move_to_end(cypher)
+            retry_info["status"] = "cached"
+            timings["retries"].append(retry_info)
+            _remember_cypher(question, cypher)
+            remember_generation(question, full_schema, cypher, pruned_schema)
+            logger.info(f"Validation skipped for previously valid query: {cypher}")
+            break
         try:
             # 2. Validate (dry-run)
-            # EXPLAIN checks syntax and binding without running the full query plan
-            t0 = time.perf_counter()
-            conn.execute(f"EXPLAIN {cypher}")
-            val_time = (time.perf_counter() - t0) * 1000
+            t0 = time.perf_counter_ns()
+            await _with_connection(partial(_explain, cypher))
+            val_time = (time.perf_counter_ns() - t0) / 1e6
             retry_info["validation_time_ms"] = val_time
             timings["total_validation_time_ms"] += val_time
+            _mark_validated(cypher)
+            _remember_cypher(question, cypher)
+            remember_generation(question, full_schema, cypher, pruned_schema)
             
             retry_info["status"] = "success"
             timings["retries"].append(retry_info)
@@ -62,7 +174,7 @@ def self_refinement_loop(question: str, full_schema: dict, conn: kuzu.Connection
             logger.info(f"Validation succeeded for query: {cypher}")
             break
         except Exception as e:
-            val_time = (time.perf_counter() - t0) * 1000
+            val_time = (time.perf_counter_ns() - t0) / 1e6
             retry_info["validation_time_ms"] = val_time
             timings["total_validation_time_ms"] += val_time
             retry_info["status"] = "failed"
@@ -74,9 +186,9 @@ def self_refinement_loop(question: str, full_schema: dict, conn: kuzu.Connection
                 break
             
             # 3. Repair
-            t0 = time.perf_counter()
-            cypher = repair_cypher(question, cypher, str(e), pruned_schema, full_schema)
-            rep_time = (time.perf_counter() - t0) * 1000
+            t0 = time.perf_counter_ns()
+            cypher = await repair_cypher(question, cypher, str(e), pruned_schema, full_schema)
+            rep_time = (time.perf_counter_ns() - t0) / 1e6
             retry_info["repair_time_ms"] = rep_time
             timings["total_llm_time_ms"] += rep_time
             
@@ -86,56 +198,239 @@ def self_refinement_loop(question: str, full_schema: dict, conn: kuzu.Connection
     return cypher, timings
 
 
+def dispatch(handler: Callable[[NATSMsg], Awaitable[None]]) -> Callable[[NATSMsg], Awaitable[None]]:
+    # nats-py awaits callbacks one at a time; run each message as its own task
+    # (keeping a reference so it isn't garbage collected) to handle them concurrently
+    async def cb(msg: NATSMsg):
+        task = asyncio.create_task(handler(msg))
+        _inflight.add(task)
+        task.add_done_callback(_inflight.discard)
+    return cb
+
+
+def _read_payload(msg: NATSMsg) -> dict:
+    # Guarded: decoding the payload is the expensive part, not just the formatting
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received a message on '%s': %s", msg.subject, msg.data.decode())
+    return orjson.loads(msg.data)
+
+
+async def run_query(question: str) -> dict:
+    """Question -> validated Cypher -> rows; the reply of the db-query topic."""
+    # One embedding per question, shared by few-shot retrieval, the Cypher cache
+    # and (forwarded in the reply) the answer-service cache
+    q_emb = await asyncio.to_thread(embed_question, question)
+
+    # Connections are only checked out around Kuzu calls, not across LLM calls,
+    # so concurrent messages aren't capped by the pool size
+    cypher, timings = await self_refinement_loop(question, _SCHEMA, q_emb)
+
+    shared = await _CY2DB.get(KUZU_DB_PATH, cypher)
+    if shared is not None:
+        (columns, rows), timings["db_execution_time_ms"] = shared, 0.0
+        timings["db_result_cache"] = "hit"
+    else:
+        columns, rows, timings["db_execution_time_ms"] = await _with_connection(partial(_execute, cypher))
+        _CY2DB.put((columns, rows), KUZU_DB_PATH, cypher)
+
+    return {
+        "question": question,
+        "cypher": cypher,
+        "columns": columns,
+        "rows": rows,
+        "timings": timings,
+        "question_embedding": q_emb,
+    }
+
+
 async def message_handler(msg: NATSMsg):
-    data = msg.data.decode()
-    logger.debug(f"Received a message on '{msg.subject}': {data}")
+    try:
+        question = _read_payload(msg).get("question")
+        if not question:
+            await msg.respond(b'{"error":"missing question"}')
+            return
+
+        await msg.respond(_dumps(await run_query(question)))
 
+    except Exception as e:
+        logger.error(f"Query failed: {e}")
+        await msg.respond(orjson.dumps({"error": str(e)}))
+
+
+async def pipeline_handler(msg: NATSMsg):
+    """Runs the query and forwards the result to the answer-service, so the API makes a single request."""
     try:
-        payload = json.loads(data)
+        payload = _read_payload(msg)
         question = payload.get("question")
         if not question:
             await msg.respond(b'{"error":"missing question"}')
             return
 
-        db = kuzu.Database(KUZU_DB_PATH, read_only=True)
-        conn = kuzu.Connection(db)
-
-        full_schema = get_schema_dict(conn)
-        # logger.debug(f"Full schema: {full_schema}")
+        result = await run_query(question)
+        if payload.get("stream_to"):
+            # The answer-service publishes answer chunks there before replying
+            result["stream_to"] = payload["stream_to"]
 
-        cypher, timings = self_refinement_loop(question, full_schema, conn)
+        t0 = time.perf_counter_ns()
+        reply = await _NC.request(answer_topic, _dumps(result), timeout=30)
+        answer_latency = (time.perf_counter_ns() - t0) / 1e6
 
-        t0 = time.perf_counter()
-        res = conn.execute(cypher)
-        timings["db_execution_time_ms"] = (time.perf_counter() - t0) * 1000
+        answer = orjson.loads(reply.data)
+        if "error" in answer:
+            await msg.respond(reply.data)
+            return
 
-        result = {
+        await msg.respond(orjson.dumps({
             "question": question,
-            "cypher": cypher,
-            "columns": res.get_column_names(), # In Kuzu 0.11+, use get_column_names() instead of column_names()
-            "rows": [list(r) for r in res],
-            "timings": timings
-        }
+            "cypher": result["cypher"],
+            "answer": answer.get("answer", ""),
+            "timings": {
+                "query_service_internal": result["timings"],
+                "answer_service_latency_ms": answer_latency,
+                "answer_service_internal": answer.get("timings", {}),
+            },
+        }))
+
+    except Exception as e:
+        logger.error(f"Pipeline failed: {e}")
+        await msg.respond(orjson.dumps({"error": str(e)}))
+
+
+def _read_schema_file() -> dict | None:
+    """The saved schema, unless it is missing or older than the database."""
+    try:
+        if os.path.getmtime(KUZU_SCHEMA_PATH) < os.path.getmtime(KUZU_DB_PATH):
+            return None
+        with open(KUZU_SCHEMA_PATH, "rb") as f:
+            return orjson.loads(f.read())
+    except (OSError, orjson.JSONDecodeError):
+        return None
+
+
+def _write_schema_file(schema: dict) -> None:
+    try:
+        with open(KUZU_SCHEMA_PATH, "wb") as f:
+            f.write(orjson.dumps(schema))
+    except OSError as e:
+        logger.warning(f"Could not save schema to '{KUZU_SCHEMA_PATH}': {e}")
+
+
+def _open_database() -> None:
+    """(Re)opens the read-only database and refills the connection pool, closing the old ones."""
+    global _DB
+    while not _POOL.empty():
+        _POOL.get_nowait().close()
+    if _DB is not None:
+        _DB.close()
+    _DB = kuzu.Database(KUZU_DB_PATH, read_only=True, buffer_pool_size=KUZU_BUFFER_POOL_SIZE)
+    for _ in range(KUZU_POOL_SIZE):
+        _POOL.put(kuzu.Connection(_DB))
+
+
+# Serializes reloads, so two of them never hold part of the semaphore each
+_RELOAD_LOCK = asyncio.Lock()
+
+
+async def _reopen_database() -> None:
+    # Taking every permit waits for in-flight queries and keeps new ones off the old connections
+    for _ in range(KUZU_POOL_SIZE):
+        await _DB_SEMAPHORE.acquire()
+    try:
+        await asyncio.to_thread(_open_database)
+    finally:
+        for _ in range(KUZU_POOL_SIZE):
+            _DB_SEMAPHORE.release()
+
+
+async def reload_schema(from_file: bool = False, reopen: bool = False) -> None:
+    """
+    Loads the schema, from KUZU_SCHEMA_PATH if allowed and up to date, otherwise re-extracts it.
+    With reopen, the database is reopened first so a rebuilt one is picked up.
+    """
+    global _SCHEMA
+    if from_file:
+        schema = _read_schema_file()
+        if schema is not None:
+            _SCHEMA = schema
+            logger.info(f"Loaded graph schema from '{KUZU_SCHEMA_PATH}'")
+            return
+
+    async with _RELOAD_LOCK:
+        if reopen:
+            await _reopen_database()
+        invalidate_schema_cache()
+        # Queries validated or reused by question were checked against the old schema
+        _VALID.clear()
+        _CYPHER_CACHE.clear()
+        _SCHEMA = await _with_connection(get_schema_dict)
+        _write_schema_file(_SCHEMA)
 
-        await msg.respond(json.dumps(result).encode())
 
+async def schema_reload_handler(msg: NATSMsg):
+    """Admin hook: reopen the database and re-extract the cached schema, e.g. after the database was rebuilt."""
+    try:
+        await reload_schema(reopen=True)
+        logger.info("Reloaded graph schema")
+        await msg.respond(orjson.dumps({"nodes": len(_SCHEMA["nodes"]), "edges": len(_SCHEMA["edges"])}))
     except Exception as e:
-        logger.error(f"Query failed: {e}")
-        await msg.respond(json.dumps({"error": str(e)}).encode())
+        logger.error(f"Schema reload failed: {e}")
+        await msg.respond(orjson.dumps({"error": str(e)}))
 
 
 async def main():
+    global _NC
     logger.info("Starting Query Service...")
 
-    nc = NATS()
+    _open_database()
+
+    await reload_schema(from_file=True)
+    logger.debug(f"Opened '{KUZU_DB_PATH}' with {KUZU_POOL_SIZE} connections")
+
+    if QUERY_BATCHING:
+        enable_batching(QUERY_BATCH_MAX_SIZE, QUERY_BATCH_WAIT_MS)
+
+    nc = _NC = NATS()
     await nc.connect(f"nats://{NATS_HOST}:{NATS_PORT}")
-    await nc.subscribe(topic, cb=message_handler)
+    # Queue group: replicas share the subscription instead of each receiving every message.
+    # Schema reloads are deliberately not grouped, every replica must see them.
+    await nc.subscribe(topic, queue=f"{topic}.workers", cb=dispatch(message_handler))
+    await nc.subscribe(pipeline_topic, queue=f"{pipeline_topic}.workers", cb=dispatch(pipeline_handler))
+    await nc.subscribe(schema_reload_topic, cb=schema_reload_handler)
 
-    logger.debug(f"Subscribed to '{topic}' on {NATS_HOST}:{NATS_PORT}")
+    logger.debug(f"Subscribed to '{topic}' and '{pipeline_topic}' on {NATS_HOST}:{NATS_PORT}")
 
     while not shutdown:
         await asyncio.sleep(1)
 
 
-if __name__ == "__main__":
+def _worker_main():
     asyncio.run(main())
+
+
+def run_workers(n: int):
+    """
+    Runs n worker processes that share the NATS queue group. Each opens the read-only
+    database itself: Kuzu's background threads don't survive fork(), so workers are
+    spawned rather than forked from a parent that already opened it. The database
+    file pages are still shared between workers through the OS page cache.
+    """
+    ctx = multiprocessing.get_context("spawn")
+    procs = [ctx.Process(target=_worker_main, name=f"query-worker-{i}") for i in range(n)]
+    for p in procs:
+        p.start()
+    logger.info(f"Started {n} query workers")
+
+    while not shutdown and any(p.is_alive() for p in procs):
+        time.sleep(1)
+
+    for p in procs:
+        p.terminate()  # SIGTERM, handled by the worker's own handle_shutdown
+    for p in procs:
+        p.join()
+
+
+if __name__ == "__main__":
+    if QUERY_WORKERS > 1:
+        run_workers(QUERY_WORKERS)
+    else:
+        asyncio.run(main())
@@ -0,0 +1,74 @@
+# --- deps ---
+import threading
+from typing import Generic, TypeVar
+
+import numpy as np
+
+from ..config import EMBEDDING_MODEL
+
+T = TypeVar("T")
+
+# Module-level singleton, loaded on first use so imports stay cheap
+_model = None
+# Callers run in worker threads; without it, concurrent first calls would each load a model
+_model_lock = threading.Lock()
+
+
+def get_model():
+    global _model
+    if _model is None:
+        with _model_lock:
+            if _model is None:
+                from sentence_transformers import SentenceTransformer  # pip install sentence-transformers
+                _model = SentenceTransformer(EMBEDDING_MODEL)
+    return _model
+
+
+def embed(texts: list[str]) -> np.ndarray:
+    """L2-normalized float32 embeddings, one row per text."""
+    return get_model().encode(texts, normalize_embeddings=True).astype(np.float32)
+
+
+def embed_question(question: str) -> np.ndarray:
+    return embed([question])[0]
+
+
+class SemanticIndex(Generic[T]):
+    """
+    Exact inner-product index over normalized embeddings (cosine similarity).
+    Sizes here are small (exemplars, recent questions), so a numpy matmul
+    is as fast as an ANN index and needs no extra dependency.
+    """
+
+    def __init__(self):
+        self.matrix = np.empty((0, 0), dtype=np.float32)
+        self.items: list[T] = []
+
+    @classmethod
+    def from_matrix(cls, matrix: np.ndarray, items: list[T]) -> "SemanticIndex[T]":
+        index = cls()
+        index.matrix = matrix
+        index.items = list(items)
+        return index
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def add(self, emb: np.ndarray, item: T) -> None:
+        if not self.items:
+            self.matrix = emb[np.newaxis, :].astype(np.float32)
+        else:
+            self.matrix = np.vstack([self.matrix, emb])
+        self.items.append(item)
+
+    def search(self, emb: np.ndarray, k: int = 1) -> list[tuple[float, T]]:
+        if not self.items:
+            return []
+        sims = self.matrix @ emb
+        k = min(k, sims.shape[0])
+        idx = np.argpartition(sims, -k)[-k:]
+        idx = idx[np.argsort(sims[idx])[::-1]]
+        return [(float(sims[i]), self.items[i]) for i in idx]
+
+
+__all__ = ["get_model", "embed", "embed_question", "SemanticIndex"]
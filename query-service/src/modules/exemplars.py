@@ -1,11 +1,18 @@
 # few_shot_exemplars.py
+from collections import OrderedDict
 from dataclasses import dataclass
+from functools import lru_cache
 from typing import List
+import os
 import re
+import threading
 
+import numpy as np
+import scipy.sparse as sp
 # pip install scikit-learn
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+from sklearn.feature_extraction.text import HashingVectorizer
+
+from .embeddings import SemanticIndex, embed
 
 
 @dataclass
@@ -42,14 +49,55 @@ EXEMPLARS: List[Exemplar] = [
 class FewShotRetriever:
     def __init__(self, exemplars: List[Exemplar]):
         self.exemplars = exemplars
-        self.vectorizer = TfidfVectorizer(ngram_range=(1, 2), min_df=1)
-        self.matrix = self.vectorizer.fit_transform([e.question for e in exemplars])
+        # Stateless (no fit, no vocabulary) and already L2-normalized, so cosine
+        # similarity is a single sparse matmul and appends never require a re-fit
+        self.vectorizer = HashingVectorizer(n_features=4096, ngram_range=(1, 2), norm="l2", alternate_sign=False)
+        self.matrix = self.vectorizer.transform([e.question for e in exemplars])
+        self._ranked = lru_cache(maxsize=1024)(self._rank)
 
-    def top_k(self, question: str, k: int = 3) -> List[Exemplar]:
+    def _rank(self, question: str, k: int) -> tuple[int, ...]:
         qv = self.vectorizer.transform([question])
-        sims = cosine_similarity(qv, self.matrix)[0]
-        order = sims.argsort()[::-1][:k]
-        return [self.exemplars[i] for i in order]
+        sims = (self.matrix @ qv.T).toarray().ravel()
+        k = min(k, sims.shape[0])
+        # Partition in O(N), then sort only the k best
+        idx = np.argpartition(sims, -k)[-k:]
+        return tuple(idx[np.argsort(sims[idx])[::-1]])
+
+    def top_k(self, question: str, k: int = 3) -> List[Exemplar]:
+        return [self.exemplars[i] for i in self._ranked(question, k)]
+
+    def add(self, exemplar: Exemplar) -> None:
+        """Append an exemplar; O(1) since the vectorizer has no state to re-fit."""
+        self.exemplars.append(exemplar)
+        qv = self.vectorizer.transform([exemplar.question])
+        self.matrix = sp.vstack([self.matrix, qv], format="csr")
+        self._ranked.cache_clear()
+
+
+class DenseRetriever:
+    """Exemplar retrieval on sentence embeddings, for callers that already embedded the question."""
+
+    def __init__(self, exemplars: List[Exemplar], embeddings: np.ndarray | None = None):
+        self.exemplars = exemplars
+        if embeddings is not None:
+            # Precomputed rows for the first len(embeddings) exemplars
+            self.index: SemanticIndex[int] = SemanticIndex.from_matrix(embeddings, range(len(embeddings)))
+        else:
+            self.index = SemanticIndex()
+        self._lock = threading.Lock()  # generate_cypher runs in worker threads
+
+    def _sync(self) -> None:
+        # Embed lazily, and only exemplars appended since the last call
+        with self._lock:
+            missing = self.exemplars[len(self.index):]
+            if missing:
+                start = len(self.index)
+                for i, emb in enumerate(embed([e.question for e in missing]), start):
+                    self.index.add(emb, i)
+
+    def top_k(self, q_emb: np.ndarray, k: int = 3) -> List[Exemplar]:
+        self._sync()
+        return [self.exemplars[i] for _, i in self.index.search(q_emb, k)]
 
 
 def format_fewshot_block(exemplars: List[Exemplar]) -> str:
@@ -64,29 +112,83 @@ def format_fewshot_block(exemplars: List[Exemplar]) -> str:
     return "\n".join(lines).strip()
 
 
-# Module-level retriever (built once).
-_retriever = FewShotRetriever(EXEMPLARS)
+# Exemplar embeddings precomputed at image build time (see save_exemplar_embeddings)
+EXEMPLAR_EMBEDDINGS_PATH = os.path.join(os.path.dirname(__file__), "exemplars.npy")
+
+
+def _load_exemplar_embeddings() -> np.ndarray | None:
+    if not os.path.exists(EXEMPLAR_EMBEDDINGS_PATH):
+        return None
+    emb = np.load(EXEMPLAR_EMBEDDINGS_PATH, mmap_mode="r")
+    # A stale file (exemplars edited without rebuilding) is ignored and embeddings are computed lazily
+    return emb if emb.shape[0] == len(EXEMPLARS) else None
+
 
+def save_exemplar_embeddings(path: str = EXEMPLAR_EMBEDDINGS_PATH) -> None:
+    np.save(path, embed([e.question for e in EXEMPLARS]))
 
-def get_fewshot_block(question: str, k: int = 3) -> str:
-    """Public helper: returns a formatted few-shot block for a given question."""
-    examples = _retriever.top_k(question, k=k)
-    return format_fewshot_block(examples)
+
+# Module-level retrievers (built once). The embedding model itself is only
+# loaded on the first request that needs it.
+_retriever = FewShotRetriever(EXEMPLARS)
+_dense_retriever = DenseRetriever(EXEMPLARS, _load_exemplar_embeddings())
+
+
+def get_fewshot_exemplars(question: str, k: int = 3, q_emb: np.ndarray | None = None) -> List[Exemplar]:
+    """The k most similar exemplars; dense retrieval if the question embedding is given."""
+    if q_emb is not None:
+        return _dense_retriever.top_k(q_emb, k=k)
+    return _retriever.top_k(question, k=k)
+
+
+# (normalized question, k, dense) -> formatted block, LRU-ordered. The embedding itself
+# is not part of the key: it is a function of the question (and unhashable).
+_BLOCK_CACHE: OrderedDict[tuple[str, int, bool], str] = OrderedDict()
+_BLOCK_CACHE_SIZE = 2048
+_block_lock = threading.Lock()
+
+
+def get_fewshot_block(question: str, k: int = 3, q_emb: np.ndarray | None = None) -> str:
+    """
+    Public helper: returns a formatted few-shot block for a given question.
+    Pass the question embedding to use dense retrieval instead of the hashed n-gram (HashingVectorizer) index.
+    """
+    key = (question.strip().lower(), k, q_emb is not None)
+    with _block_lock:
+        block = _BLOCK_CACHE.get(key)
+        if block is not None:
+            _BLOCK_CACHE.move_to_end(key)
+            return block
+    block = format_fewshot_block(get_fewshot_exemplars(question, k, q_emb))
+    with _block_lock:
+        _BLOCK_CACHE[key] = block
+        if len(_BLOCK_CACHE) > _BLOCK_CACHE_SIZE:
+            _BLOCK_CACHE.popitem(last=False)
+    return block
 
 
 # Optional helpers if you want to mutate exemplars at runtime:
 def add_exemplar(question: str, query: str) -> None:
-    """Append a new exemplar and rebuild the retriever."""
-    global _retriever
-    EXEMPLARS.append(Exemplar(question=question, query=query))
-    _retriever = FewShotRetriever(EXEMPLARS)
+    """Append a new exemplar to EXEMPLARS and the module-level retriever."""
+    # _retriever.exemplars is EXEMPLARS, so this updates both
+    _retriever.add(Exemplar(question=question, query=query))
+    with _block_lock:
+        _BLOCK_CACHE.clear()
 
 
 __all__ = [
     "Exemplar",
     "EXEMPLARS",
     "FewShotRetriever",
+    "DenseRetriever",
     "get_fewshot_block",
+    "get_fewshot_exemplars",
     "add_exemplar",
     "format_fewshot_block",
+    "save_exemplar_embeddings",
 ]
+
+
+if __name__ == "__main__":
+    save_exemplar_embeddings()
+    print(f"Saved {len(EXEMPLARS)} exemplar embeddings to {EXEMPLAR_EMBEDDINGS_PATH}")
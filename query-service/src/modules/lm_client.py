@@ -0,0 +1,50 @@
+# --- deps ---
+import atexit
+import inspect
+from functools import wraps
+
+import dspy
+import httpx
+from litellm.llms.custom_httpx.http_handler import HTTPHandler
+
+from ..config import LM_MAX_CONNECTIONS, LM_MAX_KEEPALIVE_CONNECTIONS, LM_TIMEOUT_S
+
+
+def make_http_handler() -> HTTPHandler:
+    """One long-lived HTTP/2 client, so LM calls reuse TLS connections and concurrent calls multiplex over them."""
+    client = httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_keepalive_connections=LM_MAX_KEEPALIVE_CONNECTIONS, max_connections=LM_MAX_CONNECTIONS),
+        timeout=httpx.Timeout(LM_TIMEOUT_S),
+    )
+    atexit.register(client.close)
+    return HTTPHandler(client=client, timeout=httpx.Timeout(LM_TIMEOUT_S))
+
+
+class PooledLM(dspy.LM):
+    """
+    dspy.LM whose synchronous LiteLLM calls go through the given HTTPHandler.
+    The handler is added to the request below DSPy's cache layer: it isn't serializable,
+    and as part of the request it would silently disable the cache (and get deep-copied).
+    Async calls (aforward, and so dspy.streamify) keep LiteLLM's own async client.
+    """
+
+    def __init__(self, model: str, http_handler: HTTPHandler, **kwargs):
+        super().__init__(model, **kwargs)
+        self.http_handler = http_handler
+
+    def _get_cached_completion_fn(self, completion_fn, cache):
+        # A sync wrapper around the async completion would make the cache store un-awaited coroutines
+        if inspect.iscoroutinefunction(completion_fn):
+            return super()._get_cached_completion_fn(completion_fn, cache)
+        handler = self.http_handler
+
+        # wraps keeps the function identifier, so existing cache entries still match
+        @wraps(completion_fn)
+        def with_client(request, num_retries, cache=None):
+            return completion_fn(request={**request, "client": handler}, num_retries=num_retries, cache=cache)
+
+        return super()._get_cached_completion_fn(with_client, cache)
+
+
+__all__ = ["PooledLM", "make_http_handler"]
@@ -0,0 +1,86 @@
+# --- deps ---
+import asyncio
+import inspect
+from typing import Any, Callable, Generic, TypeVar
+
+from ..config import get_logger
+
+logger = get_logger("micro_batcher")
+
+T = TypeVar("T")
+
+
+class MicroBatcher(Generic[T]):
+    """
+    Collects concurrent requests for up to max_wait_ms (or max_size items) and
+    runs them as one batch call. Single requests go through the unbatched path.
+
+    Blocking callables run in a worker thread, coroutine functions are awaited:
+      single(*args) -> T
+      batch([args, ...]) -> [T, ...]  (same order and length as the input)
+    An exception instance in the batch result fails only that request.
+    """
+
+    def __init__(self, single: Callable[..., Any], batch: Callable[[list[tuple]], Any], max_size: int, max_wait_ms: float):
+        self.single = single
+        self.batch = batch
+        self.max_size = max_size
+        self.max_wait = max_wait_ms / 1000
+        self.queue: asyncio.Queue[tuple[tuple, asyncio.Future]] = asyncio.Queue()
+        self._tasks: set[asyncio.Task] = set()
+
+    def start(self) -> None:
+        self._spawn(self._run())
+
+    def _spawn(self, coro: Any) -> None:
+        # Keep a reference so running tasks aren't garbage collected
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def submit(self, *args) -> T:
+        fut = asyncio.get_running_loop().create_future()
+        await self.queue.put((args, fut))
+        return await fut
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            items = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(items) < self.max_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    items.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            # Flush in the background so the next batch can already be collected
+            self._spawn(self._flush(items))
+
+    async def _call(self, fn: Callable, *args) -> Any:
+        if inspect.iscoroutinefunction(fn):
+            return await fn(*args)
+        return await asyncio.to_thread(fn, *args)
+
+    async def _flush(self, items: list[tuple[tuple, asyncio.Future]]) -> None:
+        args = [a for a, _ in items]
+        try:
+            if len(items) == 1:
+                results = [await self._call(self.single, *args[0])]
+            else:
+                logger.debug("Flushing batch of %d", len(items))
+                results = await self._call(self.batch, args)
+            for (_, fut), result in zip(items, results):
+                if isinstance(result, BaseException):
+                    fut.set_exception(result)
+                else:
+                    fut.set_result(result)
+        except Exception as e:
+            for _, fut in items:
+                if not fut.done():
+                    fut.set_exception(e)
+
+
+__all__ = ["MicroBatcher"]
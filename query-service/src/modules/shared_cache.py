@@ -0,0 +1,73 @@
+# --- deps ---
+import asyncio
+import hashlib
+from typing import Any
+
+import aiomcache
+import orjson
+
+from ..config import MEMCACHE_HOST, MEMCACHE_PORT, MEMCACHE_POOL_SIZE, get_logger
+
+logger = get_logger("shared_cache")
+
+# Module-level pool shared by every tier; None when MEMCACHE_HOST is unset
+_client: aiomcache.Client | None = None
+
+
+def _get_client() -> aiomcache.Client | None:
+    global _client
+    if _client is None and MEMCACHE_HOST:
+        _client = aiomcache.Client(MEMCACHE_HOST, MEMCACHE_PORT, pool_size=MEMCACHE_POOL_SIZE)
+    return _client
+
+
+def prompt_version(*texts: str) -> str:
+    """Short hash of prompt instructions and model names; changing any of them changes every key."""
+    return hashlib.blake2b("\0".join(texts).encode(), digest_size=6).hexdigest()
+
+
+class SharedCache:
+    """
+    One tier of the memcached cache shared by all replicas.
+    Keys are <version>:<tier>:<hash of the parts>, so a new prompt version orphans
+    old entries instead of reading them. Values are orjson-encoded.
+    Memcached errors are logged and treated as misses.
+    """
+
+    def __init__(self, tier: str, version: str, ttl: int):
+        self.prefix = f"{version}:{tier}:".encode()
+        self.ttl = ttl
+        self._tasks: set[asyncio.Task] = set()
+
+    def key(self, *parts: str) -> bytes:
+        digest = hashlib.blake2b("\0".join(parts).encode(), digest_size=16).hexdigest()
+        return self.prefix + digest.encode()
+
+    async def get(self, *parts: str) -> Any | None:
+        client = _get_client()
+        if client is None:
+            return None
+        try:
+            value = await client.get(self.key(*parts))
+        except Exception as e:
+            logger.warning(f"Shared cache read failed: {e}")
+            return None
+        return orjson.loads(value) if value is not None else None
+
+    def put(self, value: Any, *parts: str) -> None:
+        """Writes in the background; the caller doesn't wait for memcached."""
+        if _get_client() is None:
+            return
+        task = asyncio.create_task(self._set(self.key(*parts), value))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _set(self, key: bytes, value: Any) -> None:
+        try:
+            body = orjson.dumps(value, default=str, option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS)
+            await _client.set(key, body, exptime=self.ttl)
+        except Exception as e:
+            logger.warning(f"Shared cache write failed: {e}")
+
+
+__all__ = ["SharedCache", "prompt_version"]
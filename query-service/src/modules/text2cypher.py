@@ -1,65 +1,145 @@
 # --- deps ---
+import asyncio
+import hashlib
+import json
 import re
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from typing import Any
+import numpy as np
 from pydantic import BaseModel, Field
 from dotenv import load_dotenv
 
 import dspy
 import kuzu  # pip install kuzu
 
-from .exemplars import get_fewshot_block
+from .exemplars import format_fewshot_block, get_fewshot_block, get_fewshot_exemplars
+from .lm_client import PooledLM, make_http_handler
+from .micro_batcher import MicroBatcher
+from .shared_cache import SharedCache, prompt_version
+from ..config import DSPY_CACHE_DIR, DSPY_ASYNC_MAX_WORKERS, Q2CY_TTL, get_logger
+logger = get_logger("text2cypher")
+
 # --- LM config (OpenRouter example; swap to your provider/model as needed) ---
 load_dotenv()
 OPENROUTER_API_KEY = os.environ.get("OPENROUTER_API_KEY")
-lm = dspy.LM(
+lm = PooledLM(
     "openrouter/google/gemini-2.0-flash-001",
+    http_handler=make_http_handler(),
     api_key=OPENROUTER_API_KEY,
+    cache=True,  # keyed on model + prompt, so _repair hits include invalid_query/error_message
 )
-dspy.configure(lm=lm)
+dspy.configure(lm=lm, async_max_workers=DSPY_ASYNC_MAX_WORKERS)
+# LM responses are cached in memory and on disk; point the disk cache at a volume so it survives restarts
+dspy.configure_cache(enable_disk_cache=True, enable_memory_cache=True, disk_cache_dir=DSPY_CACHE_DIR)
 
 # --- Kuzu schema extraction ---
-def get_schema_dict(conn: kuzu.Connection) -> dict[str, list[dict]]:
-    schema = {"nodes": [], "edges": []}
+# Table functions take literal arguments, so the per-table queries are templates
+_TABLES_QUERY = "CALL SHOW_TABLES() RETURN name, type;"
+_SHOW_CONNECTION_QUERY = "CALL SHOW_CONNECTION('{}') RETURN *;"
+_TABLE_INFO_QUERY = "CALL TABLE_INFO('{}') RETURN *;"
+
+def get_schema_dict(conn: kuzu.Connection, max_workers: int = 8) -> dict[str, list[dict]]:
+    """
+    One SHOW_TABLES call for all labels, then the per-table catalog queries
+    fanned out over a thread pool, each thread on its own connection.
+    """
+    node_labels, rel_labels = [], []
+    for name, table_type in conn.execute(_TABLES_QUERY):
+        if table_type == "NODE":
+            node_labels.append(name)
+        elif table_type == "REL":
+            rel_labels.append(name)
 
-    # node labels
-    resp = conn.execute("CALL SHOW_TABLES() WHERE type = 'NODE' RETURN *;")
-    node_labels = [row[1] for row in resp]  # row[1] is table name
+    local = threading.local()
 
-    # rel labels + endpoints
-    resp = conn.execute("CALL SHOW_TABLES() WHERE type = 'REL' RETURN *;")
-    rel_labels = [row[1] for row in resp]
-    rels = []
-    for r in rel_labels:
-        cr = conn.execute(f"CALL SHOW_CONNECTION('{r}') RETURN *;")
-        for row in cr:
-            rels.append({"name": r, "from": row[0], "to": row[1]})
+    def run(query: str) -> list[list]:
+        if not hasattr(local, "conn"):
+            local.conn = kuzu.Connection(conn.database)
+        return list(local.conn.execute(query))
 
-    # node properties
+    queries = (
+        [_SHOW_CONNECTION_QUERY.format(r) for r in rel_labels]
+        + [_TABLE_INFO_QUERY.format(lbl) for lbl in node_labels + rel_labels]
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        # map keeps the input order, so the schema comes out in catalog order
+        results = list(pool.map(run, queries))
+    connections = results[:len(rel_labels)]
+    # row[1]=name, row[2]=type
+    props = {
+        lbl: [{"name": row[1], "type": row[2]} for row in rows]
+        for lbl, rows in zip(node_labels + rel_labels, results[len(rel_labels):])
+    }
+
+    schema = {"nodes": [], "edges": []}
     for lbl in node_labels:
-        props = []
-        info = conn.execute(f"CALL TABLE_INFO('{lbl}') RETURN *;")
-        for row in info:
-            # row[1]=name, row[2]=type
-            props.append({"name": row[1], "type": row[2]})
-        schema["nodes"].append({"label": lbl, "properties": props})
-
-    # rel properties
-    for rel in rels:
-        props = []
-        info = conn.execute(f"CALL TABLE_INFO('{rel['name']}') RETURN *;")
-        for row in info:
-            props.append({"name": row[1], "type": row[2]})
-        schema["edges"].append(
-            {
-                "label": rel["name"],
-                "from": rel["from"],
-                "to": rel["to"],
-                "properties": props,
-            }
-        )
+        schema["nodes"].append({"label": lbl, "properties": props[lbl]})
+    for r, rows in zip(rel_labels, connections):
+        for row in rows:
+            schema["edges"].append(
+                {
+                    "label": r,
+                    "from": row[0],
+                    "to": row[1],
+                    "properties": props[r],
+                }
+            )
     return schema
 
+_last_fingerprint: tuple[int, str] | None = None
+
+def invalidate_schema_cache() -> None:
+    """Drop everything derived from the current schema; call it whenever the schema is re-extracted."""
+    global _last_fingerprint
+    _SCHEMA_STR_CACHE.clear()
+    # A new schema dict may reuse the id() of the freed one
+    _last_fingerprint = None
+
+def normalize_question(question: str) -> str:
+    """Key form of a question: case, whitespace and trailing punctuation never change the query."""
+    return " ".join(question.lower().split()).rstrip("?.! ")
+
+def _schema_fingerprint(schema: dict) -> str:
+    # The same cached schema object is passed on every request, so only hash it once
+    global _last_fingerprint
+    if _last_fingerprint is None or _last_fingerprint[0] != id(schema):
+        digest = hashlib.sha256(json.dumps(schema, sort_keys=True).encode()).hexdigest()
+        _last_fingerprint = (id(schema), digest)
+    return _last_fingerprint[1]
+
+def format_schema(schema: dict) -> str:
+    """
+    Terse prompt form of the schema, e.g.
+    Nodes: Scholar{knownName:STRING,...}; Prize{...}
+    Edges: Scholar-[WON{...}]->Prize; ...
+    Properties of a relationship label are only listed on its first from/to pair.
+    """
+    def props(entry: dict) -> str:
+        if not entry.get("properties"):
+            return ""
+        return "{" + ",".join(f"{p['name']}:{p['type']}" for p in entry["properties"]) + "}"
+
+    nodes = [f"{n['label']}{props(n)}" for n in schema["nodes"]]
+    edges = []
+    seen = set()
+    for e in schema["edges"]:
+        rel = e["label"] if e["label"] in seen else f"{e['label']}{props(e)}"
+        seen.add(e["label"])
+        edges.append(f"{e['from']}-[{rel}]->{e['to']}")
+    return f"Nodes: {'; '.join(nodes)}\nEdges: {'; '.join(edges)}"
+
+# schema fingerprint -> format_schema() output, so a rebuilt database gets a new string
+_SCHEMA_STR_CACHE: dict[str, str] = {}
+
+def get_schema_str(schema: dict) -> str:
+    key = _schema_fingerprint(schema)
+    cached = _SCHEMA_STR_CACHE.get(key)
+    if cached is None:
+        cached = _SCHEMA_STR_CACHE[key] = format_schema(schema)
+    return cached
+
 # --- Pydantic models for structured IO (used by DSPy) ---
 class Query(BaseModel):
     query: str = Field(description="Valid Cypher query with no newlines")
@@ -87,9 +167,10 @@ class PruneSchema(dspy.Signature):
     """
     Return ONLY the subset of the labelled property graph schema relevant to the question.
     Include only nodes/edges/properties needed to answer the question.
+    The schema lists nodes as Label{property:TYPE,...} and edges as From-[REL{...}]->To.
     """
     question: str = dspy.InputField()
-    input_schema: Any = dspy.InputField()         # dict is fine
+    input_schema: str = dspy.InputField()         # see format_schema
     pruned_schema: GraphSchema = dspy.OutputField()
 
 class Text2Cypher(dspy.Signature):
@@ -115,10 +196,34 @@ class Text2Cypher(dspy.Signature):
     </RETURN_RESULTS>
     """
     question: str = dspy.InputField()
-    input_schema: Any = dspy.InputField()
+    input_schema: str = dspy.InputField()        # pruned schema as JSON
     fewshot_examples: str = dspy.InputField()   # NEW
     query: Query = dspy.OutputField()
 
+class BatchPruneSchema(dspy.Signature):
+    """
+    Apply the instructions below to each question on its own, all against the same input_schema.
+    Return exactly one pruned schema per question, in the same order.
+    """
+    questions: list[str] = dspy.InputField()
+    input_schema: str = dspy.InputField()
+    pruned_schemas: list[GraphSchema] = dspy.OutputField()
+
+class BatchText2Cypher(dspy.Signature):
+    """
+    Apply the instructions below to each question on its own; its (pruned) schema is the one at the same index in input_schemas.
+    Return exactly one query per question, in the same order.
+    """
+    questions: list[str] = dspy.InputField()
+    input_schemas: list[str] = dspy.InputField()
+    fewshot_examples: str = dspy.InputField()
+    queries: list[Query] = dspy.OutputField()
+
+# The batch prompts carry the single-question rules verbatim, so a question gets the
+# same instructions whether or not it was batched
+BatchPruneSchema.instructions = f"{BatchPruneSchema.instructions}\n\n{PruneSchema.instructions}"
+BatchText2Cypher.instructions = f"{BatchText2Cypher.instructions}\n\n{Text2Cypher.instructions}"
+
 class RepairCypher(dspy.Signature):
     """
     The previous Cypher query was invalid. Fix it based on the error message.
@@ -143,80 +248,52 @@ class RepairCypher(dspy.Signature):
 _prune = dspy.Predict(PruneSchema)
 _text2cypher = dspy.Predict(Text2Cypher)
 _repair = dspy.Predict(RepairCypher)
+_batch_prune = dspy.Predict(BatchPruneSchema)
+_batch_text2cypher = dspy.Predict(BatchText2Cypher)
+# Awaitable versions, run on DSPy's worker threads
+_prune_async = dspy.asyncify(_prune)
+_text2cypher_async = dspy.asyncify(_text2cypher)
+_repair_async = dspy.asyncify(_repair)
+_batch_prune_async = dspy.asyncify(_batch_prune)
+_batch_text2cypher_async = dspy.asyncify(_batch_text2cypher)
+
+# Shared (normalized question, schema) -> validated (cypher, pruned schema) tier. The version
+# covers the model and every prompt on the generation path, so editing one invalidates it.
+_Q2CY = SharedCache("q2cy", prompt_version(
+    lm.model,
+    PruneSchema.instructions, Text2Cypher.instructions,
+    BatchPruneSchema.instructions, BatchText2Cypher.instructions,
+), Q2CY_TTL)
+
+# --- Cypher post-processing (single tokenizer pass) ---
+# Properties to wrap in toLower()
+_TARGET_PROPS = frozenset({
+    "name", "scholar_type", "fullName", "knownName",
+    "gender", "prize_id", "category", "motivation",
+})
+# String literals (with backslash escapes) are single tokens, so nothing inside
+# them is ever mistaken for a variable, keyword or property
+_TOKEN_RE = re.compile(
+    r"""(?P<STRING>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")"""
+    r"|(?P<IDENT>\w+)"
+    r"|(?P<WS>\s+)"
+    r"|(?P<OTHER>.)",
+    re.DOTALL,
+)
+_SUFFIX_KEYWORDS = ("ORDER", "SKIP", "LIMIT")
+
+def _tokenize(query: str) -> list[tuple[str, str]]:
+    return [(m.lastgroup, m.group()) for m in _TOKEN_RE.finditer(query)]
 
 def post_process_cypher(query: str) -> str:
     """
-    Applies rule-based fixes to the generated Cypher query.
+    Applies rule-based fixes to the generated Cypher query:
+    1) bare node variables in the last RETURN are projected to knownName/name,
+    2) target properties and string literals are wrapped in toLower(),
+    3) LIMIT 100 is appended if there is no LIMIT.
     """
-    # 1. Ensure proper property projection
-    # Map variable -> Label
-    var_to_label = {}
-    # Regex for (var:Label)
-    for match in re.finditer(r"\(\s*([a-zA-Z0-9_]+)\s*:\s*([a-zA-Z0-9_]+)", query):
-        var, label = match.groups()
-        var_to_label[var] = label
-        
-    if var_to_label:
-        # Split by RETURN to find the last clause
-        parts = re.split(r"(?i)(\bRETURN\b)", query)
-        if len(parts) >= 3:
-            last_body = parts[-1]
-            
-            # Separate body from suffix (ORDER BY, LIMIT, SKIP)
-            suffix_pattern = re.compile(r"(\s+(?:ORDER\s+BY|SKIP|LIMIT).*)", re.DOTALL | re.IGNORECASE)
-            suffix_match = suffix_pattern.search(last_body)
-            
-            if suffix_match:
-                content = last_body[:suffix_match.start()]
-                suffix = suffix_match.group(1)
-            else:
-                content = last_body
-                suffix = ""
-                
-            def replace_var(m):
-                v = m.group(1)
-                if v in var_to_label:
-                    prop = "knownName" if var_to_label[v] == "Scholar" else "name"
-                    return f"{v}.{prop}"
-                return v
-            
-            # Replace bare variables not followed by . or (
-            new_content = re.sub(r"\b([a-zA-Z0-9_]+)\b(?!\s*[\.\(])", replace_var, content)
-            
-            parts[-1] = new_content + suffix
-            query = "".join(parts)
-
-    # 2. Enforce lowercase comparisons
-    # Properties to wrap in toLower()
-    target_props = [
-        "name", "scholar_type", "fullName", "knownName", 
-        "gender", "prize_id", "category", "motivation"
-    ]
-    
-    # Regex components
-    # Match properties: variable.property
-    props_pattern = r"\b\w+\.(?:" + "|".join(target_props) + r")\b"
-    # Match string literals: '...' or "..."
-    str_pattern = r"'[^']*'|\"[^\"]*\""
-    
-    # Combined target: property OR string
-    target_pattern = f"(?:{props_pattern}|{str_pattern})"
-    
-    # Regex to find targets, optionally preceded by toLower(
-    # Group 'prefix': matches 'toLower(' (case-insensitive, with optional spaces)
-    # Group 'target': matches the property or string
-    pattern = re.compile(r"(?P<prefix>(?i:toLower\s*\(\s*))?(?P<target>" + target_pattern + r")")
-    
-    def replace(match):
-        if match.group("prefix"):
-            # Already wrapped, return as is
-            return match.group(0)
-        return f"toLower({match.group('target')})"
-        
-    query = pattern.sub(replace, query)
-
-    # 3. Ensure LIMIT 100 if not present
-    if not re.search(r"\bLIMIT\s+\d+", query, re.IGNORECASE):
+    query, has_limit = _rewrite(query)
+    if not has_limit:
         query = query.rstrip()
         if query.endswith(";"):
             query = query[:-1] + " LIMIT 100;"
@@ -225,44 +302,227 @@ def post_process_cypher(query: str) -> str:
 
     return query
 
-def generate_cypher(question: str, full_schema: dict[str, list[dict]]) -> tuple[str, dict]:
+def _rewrite(query: str) -> tuple[str, bool]:
     """
-    1) Extract full schema from Kuzu
-    2) Prune schema w.r.t. the question
-    3) Select few-shot exemplars based on similarity
-    4) Generate Cypher from pruned schema + few-shot context
+    Passes 1 and 2 of post_process_cypher; also reports whether a LIMIT exists.
+    A pass is skipped when it has nothing to do, and an already well-formed query
+    (e.g. RETURN toLower(a1.knownName) ... LIMIT 5) is returned without being rebuilt.
     """
-    pruned = _prune(question=question, input_schema=full_schema).pruned_schema.model_dump()
+    tokens = _tokenize(query)
+    n = len(tokens)
+    # Neighbouring non-whitespace token of every position
+    prev_sig: list[int | None] = [None] * n
+    next_sig: list[int | None] = [None] * n
+    last = None
+    for i, (kind, _) in enumerate(tokens):
+        prev_sig[i] = last
+        if kind != "WS":
+            last = i
+    last = None
+    for i in range(n - 1, -1, -1):
+        next_sig[i] = last
+        if tokens[i][0] != "WS":
+            last = i
+
+    def text_at(i: int | None) -> str:
+        return tokens[i][1] if i is not None else ""
 
-    fewshot_block = get_fewshot_block(question, k=3)
+    def lowered(i: int) -> bool:
+        # Already inside toLower( ... )
+        p = prev_sig[i]
+        return text_at(p) == "(" and text_at(prev_sig[p]).lower() == "tolower"
+
+    def target_access(i: int) -> bool:
+        # var.prop with a target property
+        return (tokens[i][0] == "IDENT" and text_at(prev_sig[i]) != "." and next_sig[i] == i + 1
+                and tokens[i + 1][1] == "." and i + 2 < n and tokens[i + 2][1] in _TARGET_PROPS)
+
+    def needs_lower(i: int) -> bool:
+        return (tokens[i][0] == "STRING" or target_access(i)) and not lowered(i)
+
+    # Collect (var:Label) pairs, the last RETURN, whether a LIMIT exists and whether anything must be lowercased
+    var_to_label = {}
+    last_return = None
+    has_limit = False
+    lower_needed = False
+    for i, (kind, text) in enumerate(tokens):
+        if not lower_needed and (kind == "STRING" or (text == "." and i > 0)):
+            # Only string literals and var.prop accesses are ever lowercased
+            lower_needed = needs_lower(i if kind == "STRING" else i - 1)
+        if text == "(":
+            v = next_sig[i]
+            colon = next_sig[v] if v is not None else None
+            lbl = next_sig[colon] if colon is not None else None
+            if lbl is not None and tokens[v][0] == "IDENT" and tokens[colon][1] == ":" and tokens[lbl][0] == "IDENT":
+                var_to_label[tokens[v][1]] = tokens[lbl][1]
+        elif kind == "IDENT":
+            upper = text.upper()
+            if upper == "RETURN":
+                last_return = i
+            elif upper == "LIMIT" and i + 2 < n and tokens[i + 1][0] == "WS" and tokens[i + 2][1][0].isdigit():
+                has_limit = True
+
+    # Projection range: after the last RETURN, up to ORDER BY / SKIP / LIMIT
+    proj_start = proj_end = n
+    if var_to_label and last_return is not None:
+        proj_start = last_return + 1
+        for i in range(proj_start, n - 1):
+            if tokens[i][0] == "WS" and tokens[i + 1][1].upper() in _SUFFIX_KEYWORDS:
+                if tokens[i + 1][1].upper() != "ORDER" or text_at(next_sig[i + 1]).upper() == "BY":
+                    proj_end = i
+                    break
+
+    def bare_var(i: int) -> bool:
+        # Labelled variable used as-is, e.g. RETURN s
+        kind, text = tokens[i]
+        return (kind == "IDENT" and text in var_to_label
+                and text_at(prev_sig[i]) != "." and text_at(prev_sig[i]).upper() != "AS"
+                and text_at(next_sig[i]) not in (".", "("))
+
+    if not any(bare_var(i) for i in range(proj_start, proj_end)):
+        proj_start = proj_end = n
+        if not lower_needed:
+            return query, has_limit
+
+    out = []
+    i = 0
+    while i < n:
+        kind, text = tokens[i]
+        if kind == "STRING":
+            out.append(text if lowered(i) else f"toLower({text})")
+        elif target_access(i):
+            access = f"{text}.{tokens[i + 2][1]}"
+            out.append(access if lowered(i) else f"toLower({access})")
+            i += 3
+            continue
+        elif proj_start <= i < proj_end and bare_var(i):
+            access = f"{text}.{'knownName' if var_to_label[text] == 'Scholar' else 'name'}"
+            out.append(access if lowered(i) else f"toLower({access})")
+        else:
+            out.append(text)
+        i += 1
+    return "".join(out), has_limit
+
+def _schema_json(schema: GraphSchema) -> str:
+    # Straight to JSON for the prompt, skipping the dict round-trip; unset properties are dropped
+    return schema.model_dump_json(exclude_none=True)
+
+async def _generate(question: str, full_schema: dict[str, list[dict]], q_emb: np.ndarray | None = None) -> tuple[str, str]:
+    # Steps 2 and 3 are independent and run concurrently
+    prune_result, fewshot_block = await asyncio.gather(
+        _prune_async(question=question, input_schema=get_schema_str(full_schema)),
+        asyncio.to_thread(get_fewshot_block, question, 3, q_emb),
+    )
+    pruned = _schema_json(prune_result.pruned_schema)
 
-    cy = _text2cypher(
+    cy = (await _text2cypher_async(
         question=question,
         input_schema=pruned,
         fewshot_examples=fewshot_block,  
-    ).query.query
+    )).query.query
 
-    cy = post_process_cypher(cy)
+    return post_process_cypher(cy), pruned
 
+def _union_fewshot_block(items: list[tuple]) -> str:
+    # Each question's exemplars, deduplicated, as one shared block
+    seen = {}
+    for question, _, q_emb in items:
+        for ex in get_fewshot_exemplars(question, 3, q_emb):
+            seen.setdefault(ex.question, ex)
+    return format_fewshot_block(list(seen.values()))
+
+async def _generate_each(items: list[tuple]) -> list[tuple[str, str] | BaseException]:
+    # Failures are returned in place, so the batcher fails only that question
+    return await asyncio.gather(*(_generate(*item) for item in items), return_exceptions=True)
+
+async def _generate_batch(items: list[tuple]) -> list[tuple[str, str] | BaseException]:
+    """_generate for several questions with one prune and one text2cypher call in total."""
+    full_schema = items[0][1]
+    if any(schema is not full_schema for _, schema, _ in items):
+        # Only happens around a schema reload
+        return await _generate_each(items)
+
+    questions = [question for question, _, _ in items]
+    try:
+        prune_result, fewshot_block = await asyncio.gather(
+            _batch_prune_async(questions=questions, input_schema=get_schema_str(full_schema)),
+            asyncio.to_thread(_union_fewshot_block, items),
+        )
+        if len(prune_result.pruned_schemas) != len(items):
+            logger.warning(f"Batch returned {len(prune_result.pruned_schemas)} schemas for {len(items)} questions, generating one by one")
+            return await _generate_each(items)
+        pruned = [_schema_json(p) for p in prune_result.pruned_schemas]
+
+        queries = (await _batch_text2cypher_async(
+            questions=questions,
+            input_schemas=pruned,
+            fewshot_examples=fewshot_block,
+        )).queries
+    except Exception as e:
+        # e.g. adapter parse errors on the list outputs; one bad batch must not fail every question in it
+        logger.warning(f"Batch of {len(items)} generations failed ({e}), generating one by one")
+        return await _generate_each(items)
+    if len(queries) != len(items):
+        logger.warning(f"Batch returned {len(queries)} queries for {len(items)} questions, generating one by one")
+        return await _generate_each(items)
+
+    return [(post_process_cypher(q.query), p) for q, p in zip(queries, pruned)]
+
+# Set by enable_batching(); None runs every question through its own LLM calls
+_batcher: MicroBatcher[tuple[str, str]] | None = None
+
+def enable_batching(max_size: int, max_wait_ms: float) -> None:
+    """Batch concurrent generate_cypher misses into shared LLM calls. Must be called inside the running loop."""
+    global _batcher
+    _batcher = MicroBatcher(_generate, _generate_batch, max_size, max_wait_ms)
+    _batcher.start()
+
+async def generate_cypher(question: str, full_schema: dict[str, list[dict]], q_emb: np.ndarray | None = None) -> tuple[str, str]:
+    """
+    1) Take the full schema (extracted once by the caller, not per request)
+    2) Prune schema w.r.t. the question
+    3) Select few-shot exemplars based on similarity (dense if q_emb is given)
+    4) Generate Cypher from pruned schema + few-shot context
+
+    Queries another replica shared with remember_generation are reused, short-circuiting
+    the whole pipeline. With batching enabled, concurrent misses share the prune and
+    generation calls. Returns (cypher, pruned schema as JSON).
+    """
+    key = (normalize_question(question), _schema_fingerprint(full_schema))
+    shared = await _Q2CY.get(*key)
+    if shared is not None:
+        cy, pruned = shared
+    elif _batcher is not None:
+        cy, pruned = await _batcher.submit(question, full_schema, q_emb)
+    else:
+        cy, pruned = await _generate(question, full_schema, q_emb)
     return cy, pruned
 
-def repair_cypher(question: str, invalid_query: str, error_message: str, schema: dict, full_schema: dict) -> str:
-    cy = _repair(
+def remember_generation(question: str, full_schema: dict[str, list[dict]], cypher: str, pruned: str) -> None:
+    """Share the query that passed validation for this question (after any repairs) with the other replicas."""
+    _Q2CY.put((cypher, pruned), normalize_question(question), _schema_fingerprint(full_schema))
+
+def generate_cypher_sync(question: str, full_schema: dict[str, list[dict]], q_emb: np.ndarray | None = None) -> tuple[str, str]:
+    """generate_cypher for callers without an event loop."""
+    return asyncio.run(generate_cypher(question, full_schema, q_emb))
+
+async def repair_cypher(question: str, invalid_query: str, error_message: str, schema: str, full_schema: dict) -> str:
+    cy = (await _repair_async(
         question=question,
         input_schema=schema,
         full_schema=full_schema,
         invalid_query=invalid_query,
         error_message=error_message
-    ).query.query
+    )).query.query
     
     return post_process_cypher(cy)
 
 if __name__ == "__main__":
     db = kuzu.Database("nobel.kuzu", read_only=True)
     conn = kuzu.Connection(db)
-    cypher, pruned = generate_cypher(
+    cypher, pruned = generate_cypher_sync(
         "Which scholars won prizes in Physics and were affiliated with University of Cambridge?",
-        conn,
+        get_schema_dict(conn),
     )
     print("PRUNED SCHEMA:", pruned)
     print("GENERATED CYPHER:", cypher)
@@ -3,6 +3,8 @@ import logging
 
 MEMCACHE_HOST = os.getenv("MEMCACHE_HOST", "memcached")
 MEMCACHE_PORT = int(os.getenv("MEMCACHE_PORT", 11211))
+MEMCACHE_POOL_SIZE = int(os.getenv("MEMCACHE_POOL_SIZE", 16))
+MEMCACHE_EXPTIME = int(os.getenv("MEMCACHE_EXPTIME", 86400))  # seconds
 
 LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
 
@@ -16,4 +18,5 @@ def get_logger(name: str) -> logging.Logger:
 NATS_HOST = os.getenv("NATS_HOST", "nats-server")
 NATS_PORT = int(os.getenv("NATS_PORT", 4222))
 NATS_DB_QUERY_TOPIC = os.getenv("NATS_DB_QUERY_TOPIC", "db-query")
-NATS_ANSWER_TOPIC = os.getenv("NATS_ANSWER_TOPIC", "answer")
\ No newline at end of file
+NATS_ANSWER_TOPIC = os.getenv("NATS_ANSWER_TOPIC", "answer")
+NATS_PIPELINE_TOPIC = os.getenv("NATS_PIPELINE_TOPIC", "pipeline.qa")
\ No newline at end of file
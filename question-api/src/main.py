@@ -1,48 +1,94 @@
+import asyncio
 from contextlib import asynccontextmanager
 from fastapi import FastAPI, HTTPException
+from fastapi.responses import ORJSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
-import json
-import hashlib
+import logging
+import orjson
 import time
+import xxhash
 
-from pymemcache.client import base
+import aiomcache
 
 from nats.aio.client import Client as NATSClient
 
 from .config import (
     MEMCACHE_HOST,
     MEMCACHE_PORT,
+    MEMCACHE_POOL_SIZE,
+    MEMCACHE_EXPTIME,
     NATS_HOST,
     NATS_PORT,
-    NATS_DB_QUERY_TOPIC as db_query_topic,
-    NATS_ANSWER_TOPIC as answer_topic,
+    NATS_PIPELINE_TOPIC as pipeline_topic,
     get_logger,
 )
 
-mem_client = base.Client((MEMCACHE_HOST, MEMCACHE_PORT))
+# Async pool, so memcached round-trips don't block the event loop
+mem_client = aiomcache.Client(MEMCACHE_HOST, MEMCACHE_PORT, pool_size=MEMCACHE_POOL_SIZE)
 nats_client = NATSClient()
+# Background cache writes; keep references so they aren't garbage collected
+_pending_writes: set[asyncio.Task] = set()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     await nats_client.connect(servers=[f"nats://{NATS_HOST}:{NATS_PORT}"])
+    # Opens the first pooled memcached connection before traffic arrives
+    try:
+        await mem_client.version()
+    except Exception as e:
+        # Memcached being down only costs cache misses
+        logger.warning(f"Memcached at {MEMCACHE_HOST}:{MEMCACHE_PORT} is unreachable, serving without cache: {e}")
 
-    logger.debug(f"Connected to NATS at nats://{NATS_HOST}:{NATS_PORT}")
+    logger.debug("Connected to NATS at nats://%s:%s", NATS_HOST, NATS_PORT)
     nats_conn = nats_client.connected_url
 
     if not nats_conn:
         logger.error("Failed to connect to NATS server")
     else:
-        logger.debug(f"Successfully connected to NATS server on {nats_conn.geturl()} on topics {db_query_topic}, {answer_topic}")
+        logger.debug("Successfully connected to NATS server on %s on topic %s", nats_conn.geturl(), pipeline_topic)
 
     yield
     await nats_client.drain()
-    mem_client.close()
+    await asyncio.gather(*_pending_writes)
+    await mem_client.close()
 
 logger = get_logger("main")
 
 class QuestionRequest(BaseModel):
     question: str
 
-app = FastAPI(lifespan=lifespan)
+async def get_cached(cache_key: bytes) -> bytes | None:
+    try:
+        return await mem_client.get(cache_key)
+    except Exception as e:
+        # A cache failure is treated as a miss
+        logger.warning(f"Failed to read cached answer: {e}")
+        return None
+
+async def cache_answer(cache_key: bytes, question: str, answer: str):
+    try:
+        # Store the finished cache-hit response body, so hits are returned without any serialization
+        body = orjson.dumps({"question": question, "answer": answer, "cached": True})
+        await mem_client.set(cache_key, body, exptime=MEMCACHE_EXPTIME)
+        logger.debug("Cached answer for question hash: %s...", cache_key[:19])
+    except Exception as e:
+        # Log but don't fail if caching fails
+        logger.warning(f"Failed to cache answer: {e}")
+
+def schedule_cache_write(cache_key: bytes, question: str, answer: str):
+    task = asyncio.create_task(cache_answer(cache_key, question, answer))
+    _pending_writes.add(task)
+    task.add_done_callback(_pending_writes.discard)
+
+def make_cache_key(question: str) -> bytes:
+    # Use a safe memcache key (hash of the question) because memcached keys
+    # cannot contain whitespace or certain characters. We store and lookup by
+    # the XXH3-128 hex digest of the question string; a cache key needs no
+    # cryptographic strength. The v3: prefix keeps it apart from older keys, whose
+    # values were the bare answer text rather than a JSON response body.
+    return b"v3:" + xxhash.xxh3_128_hexdigest(question).encode()
+
+# Responses are serialized with orjson rather than the stdlib json encoder
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 @app.get("/")
 async def root():
@@ -56,71 +102,95 @@ async def health_check():
 
 @app.post("/question")
 async def answer_question(question: QuestionRequest):
-    logger.debug(f"Question received: {question.question}")
+    q = question.question
+    logger.debug("Question received: %s", q)
 
-    # Use a safe memcache key (hash of the question) because memcached keys
-    # cannot contain whitespace or certain characters. We store and lookup by
-    # the SHA-256 hex digest of the question string.
-    cache_key = hashlib.sha256(question.question.encode()).hexdigest()
-    cached_value = mem_client.get(cache_key)
+    cache_key = make_cache_key(q)
+    cached_value = await get_cached(cache_key)
     if cached_value:
-        logger.debug(f"Cache hit for question: {question.question}")
-        # pymemcache returns bytes for stored values; decode as UTF-8
-        if isinstance(cached_value, (bytes, bytearray)):
-            cached_value = cached_value.decode('utf-8')
-        return {"question": question.question, "answer": cached_value, "cached": True}
+        logger.debug("Cache hit for question: %s", q)
+        # The stored value already is the JSON response body
+        return Response(content=cached_value, media_type="application/json")
 
-    logger.debug(f"Cache miss for question: {question.question}")
+    logger.debug("Cache miss for question: %s", q)
 
     timings = {}
 
     #TODO: implement calls to NATS and other services to get the answer
 
-    # Step 1: Query the database service
+    # Step 1: Query the database and generate the answer in one request; the
+    # query-service forwards its result to the answer-service itself
     try:
-        logger.debug(f"Requesting query on NATS topic {db_query_topic}")
-        db_request_payload = json.dumps({"question": question.question}).encode()
-        
-        t0 = time.perf_counter()
-        db_answer = await nats_client.request(db_query_topic, db_request_payload, timeout=30)
-        timings["query_service_latency_ms"] = (time.perf_counter() - t0) * 1000
-        
-        data = db_answer.data.decode()
-        db_response_json = json.loads(data)
-        timings["query_service_internal"] = db_response_json.get("timings", {})
-
-        preview = data[:300] + "..." if len(data) > 300 else data
-        logger.debug(f"Received DB answer: {preview}")
+        logger.debug("Requesting answer on NATS topic %s", pipeline_topic)
+        request_payload = orjson.dumps({"question": q})
+
+        t0 = time.perf_counter_ns()
+        reply = await nats_client.request(pipeline_topic, request_payload, timeout=60)
+        timings["pipeline_latency_ms"] = (time.perf_counter_ns() - t0) / 1e6
+
+        response_json = orjson.loads(reply.data)
+        if "error" in response_json:
+            raise RuntimeError(response_json["error"])
+        answer = response_json.get("answer", "")
+        timings.update(response_json.get("timings", {}))
+
+        if logger.isEnabledFor(logging.DEBUG):
+            preview = answer[:300] + "..." if len(answer) > 300 else answer
+            logger.debug("Received answer: %s", preview)
     except Exception as e:
-        logger.error(f"Failed to retrieve data from db service: {e}")
-        raise HTTPException(status_code=500, detail="Failed to query database")
+        logger.error(f"Failed to answer question: {e}")
+        raise HTTPException(status_code=500, detail="Failed to answer question")
 
-    # Step 2: Generate natural language answer
-    try:
-        logger.debug(f"Requesting answer on NATS topic {answer_topic}")
-        
-        t0 = time.perf_counter()
-        question_answer = await nats_client.request(answer_topic, data.encode(), timeout=30)
-        timings["answer_service_latency_ms"] = (time.perf_counter() - t0) * 1000
-        
-        answer_data = question_answer.data.decode('utf-8')
-        answer_response_json = json.loads(answer_data)
-        answer = answer_response_json.get("answer", "")
-        timings["answer_service_internal"] = answer_response_json.get("timings", {})
-
-        preview = answer[:300] + "..." if len(answer) > 300 else answer
-        logger.debug(f"Received answer: {preview}")
-    except Exception as e:
-        logger.error(f"Failed to generate answer: {e}")
-        raise HTTPException(status_code=500, detail="Failed to generate answer")
+    # Step 2: Cache the answer in the background; the response doesn't wait for the write
+    schedule_cache_write(cache_key, q, answer)
+
+    # Returned as a response object, so FastAPI doesn't run it through jsonable_encoder first
+    return ORJSONResponse({"question": q, "answer": answer, "timings": timings})
 
-    # Step 3: Cache the answer (encode as UTF-8 bytes for memcached)
+@app.post("/question/stream")
+async def stream_question(question: QuestionRequest):
+    """Like /question, but the answer is streamed as plain text while it is being generated."""
+    q = question.question
+    logger.debug("Streaming question received: %s", q)
+
+    cache_key = make_cache_key(q)
+    cached_value = await get_cached(cache_key)
+    if cached_value:
+        logger.debug("Cache hit for question: %s", q)
+        answer = orjson.loads(cached_value)["answer"]
+        return StreamingResponse(iter([answer]), media_type="text/plain; charset=utf-8")
+
+    # Answer chunks and then the final pipeline reply all arrive on one private inbox
+    inbox = nats_client.new_inbox()
+    sub = await nats_client.subscribe(inbox)
     try:
-        # Store the answer as UTF-8 encoded bytes to handle non-ASCII characters
-        mem_client.set(cache_key, answer.encode('utf-8'))
-        logger.debug(f"Cached answer for question hash: {cache_key[:16]}...")
+        request_payload = orjson.dumps({"question": q, "stream_to": inbox})
+        await nats_client.publish(pipeline_topic, request_payload, reply=inbox)
+        # Wait for the first message before answering, so failures can still be a 500
+        first = orjson.loads((await sub.next_msg(timeout=60)).data)
+        if "error" in first:
+            raise RuntimeError(first["error"])
     except Exception as e:
-        # Log but don't fail if caching fails
-        logger.warning(f"Failed to cache answer: {e}")
-
-    return {"question": question.question, "answer": answer, "timings": timings}
+        await sub.unsubscribe()
+        logger.error(f"Failed to answer question: {e}")
+        raise HTTPException(status_code=500, detail="Failed to answer question")
+
+    async def chunks():
+        message = first
+        parts = []
+        try:
+            while "chunk" in message:
+                parts.append(message["chunk"])
+                yield message["chunk"]
+                message = orjson.loads((await sub.next_msg(timeout=60)).data)
+            if "error" in message:
+                logger.error(f"Failed to answer question: {message['error']}")
+                return
+            # Final reply: the full answer is cached only once the stream completed
+            schedule_cache_write(cache_key, q, message.get("answer", "".join(parts)))
+        except Exception as e:
+            logger.error(f"Answer stream interrupted: {e}")
+        finally:
+            await sub.unsubscribe()
+
+    return StreamingResponse(chunks(), media_type="text/plain; charset=utf-8")